@@ -0,0 +1,589 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from urllib.parse import urlsplit
+from sqlalchemy import create_engine
+from lol_customs import members, query_service, riot_tournament_api, tournament_libs
+from lol_customs.lobby_roster import LobbyRoster
+from lol_customs.polling_worker import PollingWorker, LOBBY_TASK
+
+
+class SimulatedClock:
+    """
+    A clock that only moves when told to, so a replayed night runs as fast as the CPU allows
+    """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def use_database(module, url):
+    """
+    Point a module's engine and session at a different database, eg: an in-memory SQLite database for benchmarks
+    :param module: tournament_libs or members
+    :param url: SQLAlchemy database URL
+    :return: the new engine
+    """
+    module.session.close()
+    engine = create_engine(url, connect_args={"timeout": 30})
+    module.engine = engine
+    module.Base.metadata.bind = engine
+    module.session.bind = engine
+    module.Base.metadata.create_all(engine)
+    return engine
+
+
+def analyse_recording(path):
+    """
+    Find what happened during a recorded tournament night, and when
+    :param path: a log written by riot_tournament_api.start_recording
+    :return: dict with the tournament name, the recorded game creations and the time each game was first seen
+    started and finished by the API
+    """
+    night = {
+        "tournament_name": None,
+        "games": [],
+        "started": {},
+        "finished": {},
+        "duration": 0
+    }
+
+    for offset, method, url, body, status_code, response in riot_tournament_api.load_recording(path):
+        path_segments = urlsplit(url).path.split("/")
+        night["duration"] = max(night["duration"], offset)
+
+        if method == "POST" and path_segments[-1] == "tournaments" and night["tournament_name"] is None:
+            night["tournament_name"] = body["name"]
+        elif method == "POST" and path_segments[-1] == "codes":
+            night["games"].append((offset, body["mapType"], body["teamSize"]))
+        elif method == "GET" and "lobby-events" in path_segments and status_code == 200 and response:
+            code = path_segments[-1]
+            if code not in night["started"] and \
+                    any(x["eventType"] == "ChampSelectStartedEvent" for x in response["eventList"]):
+                night["started"][code] = offset
+        elif method == "GET" and path_segments[-1] == "ids" and status_code == 200 and response:
+            code = path_segments[-2]
+            if code not in night["finished"]:
+                night["finished"][code] = offset
+
+    return night
+
+
+def _latency(detected, actual):
+    """
+    :param detected: dict of tournament_code -> time the poller noticed the event
+    :param actual: dict of tournament_code -> time the event was first visible in the API
+    :return: tuple of (mean latency, max latency, number of events never detected)
+    """
+    latencies = [detected[code] - actual[code] for code in actual if code in detected]
+    missed = len([code for code in actual if code not in detected])
+
+    if latencies:
+        return sum(latencies) / len(latencies), max(latencies), missed
+    else:
+        return 0, 0, missed
+
+
+def run_night(path, night, poll_interval, cache_ttl, lobby_roster=False):
+    """
+    Replays a recorded tournament night through TournamentManager with the given polling configuration
+    :param path: the recording log
+    :param night: result of analyse_recording for the log
+    :param poll_interval: seconds between polls of the open and active games
+    :param cache_ttl: seconds API responses are cached for
+    :param lobby_roster: also fetch the players in each open lobby every poll, like the bot's lobby listing
+    :return: dict of results
+    """
+    clock = SimulatedClock()
+    use_database(tournament_libs, "sqlite://")
+    use_database(members, "sqlite://")
+    replay = riot_tournament_api.start_replay(path, clock=clock)
+    riot_tournament_api.set_cache_ttl(cache_ttl)
+    riot_tournament_api.call_counts.clear()
+
+    pending_games = list(night["games"])
+    detected_start = {}
+    detected_finish = {}
+    cpu_start = time.process_time()
+
+    try:
+        manager = tournament_libs.TournamentManager()
+        manager.start_tournament(night["tournament_name"])
+        tournament = manager.get_active_tournaments()[0]
+
+        while clock.now <= night["duration"] + poll_interval:
+            # Create games at the time they were created during the recorded night
+            while pending_games and pending_games[0][0] <= clock.now:
+                offset, map_name, team_size = pending_games[0]
+
+                if tournament.create_game("bench", map_name, team_size=team_size):
+                    pending_games.pop(0)
+                else:
+                    break
+
+            for game in tournament.get_open_games():
+                if lobby_roster:
+                    game.get_players_in_lobby()
+
+                if game.is_game_started():
+                    detected_start[game.tournament_code] = clock.now
+
+            for game in tournament.check_for_finished_games():
+                detected_finish[game.tournament_code] = clock.now
+
+            clock.advance(poll_interval)
+    finally:
+        cpu_time = time.process_time() - cpu_start
+        riot_tournament_api.stop_replay()
+        riot_tournament_api.set_cache_ttl(0)
+
+    return {
+        "poll_interval": poll_interval,
+        "cache_ttl": cache_ttl,
+        "api_calls": sum(riot_tournament_api.call_counts.values()),
+        "call_counts": dict(riot_tournament_api.call_counts),
+        "replay_misses": replay.misses,
+        "start_latency": _latency(detected_start, night["started"]),
+        "finish_latency": _latency(detected_finish, night["finished"]),
+        "cpu_time": cpu_time
+    }
+
+
+def night_benchmark(args):
+    night = analyse_recording(args.recording)
+    print("Recorded night: {} games created, {} started, {} finished over {:.0f}s".format(
+        len(night["games"]), len(night["started"]), len(night["finished"]), night["duration"]))
+    print("{:>6} {:>6} {:>9} {:>17} {:>18} {:>8} {:>7}".format(
+        "poll", "cache", "api_calls", "start_lat avg/max", "finish_lat avg/max", "missed", "cpu_s"))
+
+    for poll_interval in args.poll:
+        for cache_ttl in args.cache_ttl:
+            result = run_night(args.recording, night, poll_interval, cache_ttl, args.lobby_roster)
+            start_mean, start_max, start_missed = result["start_latency"]
+            finish_mean, finish_max, finish_missed = result["finish_latency"]
+            print("{:>6} {:>6} {:>9} {:>8.1f}/{:<8.1f} {:>9.1f}/{:<8.1f} {:>8} {:>7.3f}".format(
+                poll_interval, cache_ttl, result["api_calls"], start_mean, start_max, finish_mean, finish_max,
+                start_missed + finish_missed, result["cpu_time"]))
+
+            if args.verbose:
+                for endpoint, count in sorted(result["call_counts"].items()):
+                    print("        {:>6} {}".format(count, endpoint))
+
+            if result["replay_misses"]:
+                print("        WARNING: {} requests were not found in the recording".format(result["replay_misses"]))
+
+
+def _seed_query_data(member_count, game_count):
+    """
+    Fill the member and tournament databases with validated and unvalidated members, and open and active games
+    :return: tuple of (list of discord IDs, Tournament)
+    """
+    manager = members.MembersManager()
+    discord_ids = []
+
+    for number in range(member_count):
+        member = manager.create_member(discord_name="member{}".format(number), discord_id=str(100000 + number))
+        discord_ids.append(member.discord_id)
+
+        if number % 2 == 0:
+            member.summoner_name = "Summoner{}".format(number)
+            member.realm = "NA"
+            member.validated = True
+    members.session.commit()
+
+    tournament = tournament_libs.Tournament(name="bench", completed=False, provider_id=0)
+    tournament_libs.session.add(tournament)
+    tournament_libs.session.commit()
+
+    for number in range(game_count):
+        _add_game(tournament, number)
+
+        if number % 2 == 0:
+            tournament.get_open_games()[0].start_game(lobby_events={"eventList": []})
+
+    return discord_ids, tournament
+
+
+def _add_game(tournament, number):
+    game = tournament_libs.GameInstance(tournament_id=tournament.id, creator_discord_id="bench", map_name="SUMMONERS_RIFT",
+                                        create_date=datetime.now(), tournament_code="BENCH{}".format(number))
+    tournament_libs.session.add(game)
+    tournament_libs.session.commit()
+
+
+def _run_queries(commands, tournament, write_every, cached):
+    """
+    Answer a burst of bot commands, starting a game and opening a new one every write_every commands
+    :return: elapsed seconds
+    """
+    if cached:
+        handlers = {
+            "nickname": query_service.generate_discord_nickname,
+            "validated": query_service.is_user_validated,
+            "validation": lambda x: query_service.start_validation(x, "bench"),
+            "open_games": lambda x: query_service.get_open_games(),
+            "active_games": lambda x: query_service.get_active_games()
+        }
+    else:
+        handlers = {
+            "nickname": members.generate_discord_nickname,
+            "validated": members.is_user_validated,
+            "validation": lambda x: members.start_validation(x, "bench"),
+            "open_games": lambda x: tournament.get_open_games(),
+            "active_games": lambda x: tournament.get_active_games()
+        }
+
+    game_number = len(tournament.game_instances)
+    start = time.perf_counter()
+
+    for count, (command, discord_id) in enumerate(commands, 1):
+        handlers[command](discord_id)
+
+        if write_every and count % write_every == 0:
+            # An empty lobby keeps start_game from calling the Riot API, so only database work is timed
+            tournament.get_open_games()[0].start_game(lobby_events={"eventList": []})
+            _add_game(tournament, game_number)
+            game_number += 1
+
+    return time.perf_counter() - start
+
+
+def query_benchmark(args):
+    use_database(members, "sqlite://")
+    use_database(tournament_libs, "sqlite://")
+    query_service.clear_cache()
+    discord_ids, tournament = _seed_query_data(args.members, args.games)
+
+    rng = random.Random(args.seed)
+    command_names = ["nickname", "validated", "validation", "open_games", "active_games"]
+    commands = []
+
+    for _ in range(args.commands):
+        command = rng.choice(command_names)
+
+        # Nicknames are only generated for validated members, who are the even numbered ones
+        if command == "nickname":
+            commands.append((command, rng.choice(discord_ids[::2])))
+        else:
+            commands.append((command, rng.choice(discord_ids)))
+
+    direct = _run_queries(commands, tournament, args.write_every, cached=False)
+    cached = _run_queries(commands, tournament, args.write_every, cached=True)
+
+    print("{} bot commands, {} members, {} games, a game started every {} commands".format(
+        args.commands, args.members, args.games, args.write_every))
+    print("{:>8} {:>10} {:>12}".format("path", "seconds", "commands/s"))
+    print("{:>8} {:>10.3f} {:>12.0f}".format("direct", direct, args.commands / direct))
+    print("{:>8} {:>10.3f} {:>12.0f}".format("cached", cached, args.commands / cached))
+
+
+def _write_worker_recording(path, game_count):
+    """
+    Write a recording where every game has already started and finished, so each needs one lobby and two match calls
+    """
+    lobby_url = "https://americas.api.riotgames.com/lol/tournament/v3/lobby-events/by-code/{}"
+    ids_url = "https://na1.api.riotgames.com/lol/match/v3/matches/by-tournament-code/{}/ids"
+    match_url = "https://na1.api.riotgames.com/lol/match/v3/matches/{}/by-tournament-code/{}"
+    lobby_events = {"eventList": [{"eventType": "ChampSelectStartedEvent", "summonerId": "1", "timestamp": "0"}]}
+
+    with open(path, "w") as log_file:
+        for number in range(game_count):
+            code = "BENCH{}".format(number)
+            for entry in [[0, "GET", lobby_url.format(code), None, 200, lobby_events],
+                          [0, "GET", ids_url.format(code), None, 200, [number]],
+                          [0, "GET", match_url.format(number, code), None, 200, {"gameId": number}]]:
+                log_file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+
+def _worker_process(database_url, recording, args, worker_number, abandon, ready, results):
+    """
+    Run a PollingWorker until every game is finished, then report which games it started and finished
+    """
+    use_database(tournament_libs, database_url)
+    use_database(members, database_url)
+    worker = PollingWorker(worker_id="bench-{}".format(worker_number), lease_seconds=args.lease_seconds,
+                           batch_size=args.batch_size)
+    # Start polling together, so process start-up isn't part of the measured time
+    ready.wait(timeout=args.timeout)
+    riot_tournament_api.start_replay(recording, latency=args.api_latency)
+    started = []
+    finished = []
+
+    if abandon:
+        # Claim games and die without polling them, other workers have to steal them once the leases expire
+        worker.claim(LOBBY_TASK)
+    else:
+        while tournament_libs.session.query(tournament_libs.GameInstance)\
+                .filter(tournament_libs.GameInstance.finish_date==None).count() > 0:
+            started_games, finished_games = worker.poll_once()
+            started += [x.id for x in started_games]
+            finished += [x.id for x in finished_games]
+
+            if not started_games and not finished_games:
+                # Everything left is leased by other workers
+                time.sleep(0.05)
+
+    results.put((worker_number, started, finished, sum(riot_tournament_api.call_counts.values())))
+
+
+def run_workers(worker_count, args, directory):
+    """
+    Split the polling of a batch of games between worker processes sharing a SQLite database
+    :return: dict of results
+    """
+    database_url = "sqlite:///" + os.path.join(directory, "workers{}.db".format(worker_count))
+    recording = os.path.join(directory, "workers.log")
+    _write_worker_recording(recording, args.games)
+
+    use_database(tournament_libs, database_url)
+    use_database(members, database_url)
+    tournament = tournament_libs.Tournament(name="bench", completed=False, provider_id=0)
+    tournament_libs.session.add(tournament)
+    tournament_libs.session.commit()
+
+    for number in range(args.games):
+        tournament_libs.session.add(tournament_libs.GameInstance(
+            tournament_id=tournament.id, creator_discord_id="bench", map_name="SUMMONERS_RIFT",
+            create_date=datetime.now(), tournament_code="BENCH{}".format(number)))
+    tournament_libs.session.commit()
+    tournament_libs.session.close()
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    ready = context.Barrier(worker_count + (1 if args.abandon else 0) + 1)
+    processes = [context.Process(target=_worker_process,
+                                 args=(database_url, recording, args, x, False, ready, results))
+                 for x in range(worker_count)]
+
+    if args.abandon:
+        processes.append(context.Process(target=_worker_process,
+                                         args=(database_url, recording, args, worker_count, True, ready, results)))
+
+    for process in processes:
+        process.start()
+
+    try:
+        ready.wait(timeout=args.timeout)
+    except threading.BrokenBarrierError:
+        # A worker died during start-up, the checks below report it
+        pass
+
+    start = time.perf_counter()
+
+    # A worker that crashes never reports, so stop waiting once every worker exited or the timeout passed
+    worker_results = {}
+    while len(worker_results) < len(processes) and time.perf_counter() - start < args.timeout:
+        try:
+            result = results.get(timeout=0.5)
+            worker_results[result[0]] = result
+        except queue.Empty:
+            if not any(x.is_alive() for x in processes):
+                break
+
+    # Pick up results that were still in flight when the last worker exited
+    while len(worker_results) < len(processes):
+        try:
+            result = results.get(timeout=1)
+            worker_results[result[0]] = result
+        except queue.Empty:
+            break
+
+    for process in processes:
+        # Workers that reported are just exiting, only stuck ones are killed
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+    elapsed = time.perf_counter() - start
+
+    failed_workers = [number for number, process in enumerate(processes)
+                      if number not in worker_results or process.exitcode != 0]
+    started = [game_id for x in worker_results.values() for game_id in x[1]]
+    finished = [game_id for x in worker_results.values() for game_id in x[2]]
+    finished_in_db = tournament_libs.session.query(tournament_libs.GameInstance)\
+        .filter(tournament_libs.GameInstance.finish_date!=None).count()
+
+    return {
+        "workers": worker_count,
+        "seconds": elapsed,
+        "api_calls": sum(x[3] for x in worker_results.values()),
+        "failed_workers": failed_workers,
+        "duplicate_starts": len(started) - len(set(started)),
+        "duplicate_finishes": len(finished) - len(set(finished)),
+        "exactly_once": not failed_workers and sorted(started) == sorted(set(started))
+                        and len(set(finished)) == args.games and len(finished) == args.games
+                        and finished_in_db == args.games
+    }
+
+
+def worker_benchmark(args):
+    print("{} games, {}s simulated API latency{}".format(
+        args.games, args.api_latency, ", plus one worker that dies holding leases" if args.abandon else ""))
+    print("{:>8} {:>8} {:>8} {:>9} {:>11} {:>13}".format(
+        "workers", "seconds", "games/s", "api_calls", "duplicates", "exactly_once"))
+
+    failed = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for worker_count in args.workers:
+            result = run_workers(worker_count, args, directory)
+            print("{:>8} {:>8.2f} {:>8.1f} {:>9} {:>11} {:>13}".format(
+                worker_count, result["seconds"], args.games / result["seconds"], result["api_calls"],
+                result["duplicate_starts"] + result["duplicate_finishes"], str(result["exactly_once"])))
+
+            if result["failed_workers"]:
+                print("        FAILED: workers {} crashed or timed out".format(
+                    ", ".join(str(x) for x in result["failed_workers"])))
+
+            if not result["exactly_once"]:
+                failed.append(worker_count)
+
+    if failed:
+        # Exit non-zero so this can be run as the multi-process test
+        sys.exit("Games were not processed exactly once with {} workers".format(", ".join(str(x) for x in failed)))
+
+
+def _lobby_event_lists(lobby_count, players, quits):
+    """
+    Generate lobby-events responses with players joining a lobby, some of them quitting and being replaced
+    :return: list of JSON encoded lobby-events responses
+    """
+    event_lists = []
+
+    for lobby in range(lobby_count):
+        first_id = 20000000 + lobby * 100
+        events = [{"eventType": "PracticeGameCreatedEvent", "summonerId": str(first_id), "timestamp": "1000"}]
+
+        for number in range(1, players + quits):
+            events.append({"eventType": "PlayerJoinedGameEvent", "summonerId": str(first_id + number),
+                           "timestamp": str(1000 + number)})
+
+        for number in range(1, quits + 1):
+            events.append({"eventType": "PlayerQuitGameEvent", "summonerId": str(first_id + number),
+                           "timestamp": str(2000 + number)})
+
+        event_lists.append(json.dumps({"eventList": events}))
+
+    return event_lists
+
+
+def _dict_roster(event_list):
+    """
+    The summonerId -> [timestamp, eventType] structure GameInstance.get_players_in_lobby used to build every poll
+    """
+    player_actions = {}
+
+    for event in event_list:
+        if event['summonerId'] not in player_actions or player_actions[event['summonerId']][0] < event['timestamp']:
+            player_actions[event['summonerId']] = [event['timestamp'], event['eventType']]
+
+    return player_actions
+
+
+def _traced_bytes(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, used
+
+
+def roster_benchmark(args):
+    event_lists = _lobby_event_lists(args.lobbies, args.players, args.quits)
+
+    # Both structures are built from freshly decoded responses, so the dicts keep the response strings they reference
+    dict_rosters, dict_bytes = _traced_bytes(lambda: [_dict_roster(json.loads(x)["eventList"]) for x in event_lists])
+    del dict_rosters
+
+    def build_rosters():
+        rosters = [LobbyRoster(x) for x in range(len(event_lists))]
+        for roster, event_list in zip(rosters, event_lists):
+            roster.apply_events(json.loads(event_list)["eventList"])
+            roster.diff()
+        return rosters
+
+    rosters, roster_bytes = _traced_bytes(build_rosters)
+
+    # A tick where one player per lobby leaves and another joins
+    start = time.perf_counter()
+    for roster in rosters:
+        first_id = roster.summoner_ids[0]
+        roster.apply_event(first_id + args.players + args.quits, 3000, "PlayerJoinedGameEvent")
+        roster.apply_event(first_id, 3001, "PlayerQuitGameEvent")
+        roster.diff()
+    tick = time.perf_counter() - start
+
+    print("{} lobbies, {} players each, {} quits per lobby".format(args.lobbies, args.players, args.quits))
+    print("{:>28} {:>14}".format("structure", "bytes/lobby"))
+    print("{:>28} {:>14.0f}".format("dict of lists", dict_bytes / args.lobbies))
+    print("{:>28} {:>14.0f}".format("LobbyRoster (tracemalloc)", roster_bytes / args.lobbies))
+    print("{:>28} {:>14.0f}".format("LobbyRoster.size_bytes()", sum(x.size_bytes() for x in rosters) / args.lobbies))
+    print("join/quit/diff tick: {:.2f}us per lobby".format(tick / args.lobbies * 1000000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline benchmarks for custom game tracking")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    night_parser = subparsers.add_parser("night", help="Replay a recorded tournament night with different polling "
+                                                       "and caching configurations")
+    night_parser.add_argument("recording", help="log written by riot_tournament_api.start_recording")
+    night_parser.add_argument("--poll", type=float, nargs="+", default=[5, 15, 30],
+                              help="seconds between polls")
+    night_parser.add_argument("--cache-ttl", type=float, nargs="+", default=[0, 5],
+                              help="seconds to cache API responses for")
+    night_parser.add_argument("--lobby-roster", action="store_true",
+                              help="also fetch lobby players every poll, the recording must include summoner lookups")
+    night_parser.add_argument("--verbose", action="store_true", help="show API calls per endpoint")
+    night_parser.set_defaults(func=night_benchmark)
+
+    query_parser = subparsers.add_parser("queries", help="Throughput of bot commands, direct against the cached "
+                                                         "query service")
+    query_parser.add_argument("--commands", type=int, default=20000, help="number of bot commands to answer")
+    query_parser.add_argument("--members", type=int, default=500)
+    query_parser.add_argument("--games", type=int, default=20)
+    query_parser.add_argument("--write-every", type=int, default=500,
+                              help="start a game every N commands, 0 for a read-only burst")
+    query_parser.add_argument("--seed", type=int, default=1)
+    query_parser.set_defaults(func=query_benchmark)
+
+    worker_parser = subparsers.add_parser("workers", help="Split lobby and match polling between worker processes "
+                                                          "and check every game is processed exactly once")
+    worker_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4],
+                               help="number of worker processes to run")
+    worker_parser.add_argument("--games", type=int, default=100)
+    worker_parser.add_argument("--api-latency", type=float, default=0.02, help="seconds per replayed API request")
+    worker_parser.add_argument("--lease-seconds", type=float, default=2)
+    worker_parser.add_argument("--batch-size", type=int, default=5, help="games each worker claims per task")
+    worker_parser.add_argument("--timeout", type=float, default=300,
+                               help="seconds to wait for the workers before failing the run")
+    worker_parser.add_argument("--abandon", action="store_true",
+                               help="add a worker that claims games and exits without polling them")
+    worker_parser.set_defaults(func=worker_benchmark)
+
+    roster_parser = subparsers.add_parser("roster", help="Memory per tracked lobby and roster update speed")
+    roster_parser.add_argument("--lobbies", type=int, default=500)
+    roster_parser.add_argument("--players", type=int, default=10)
+    roster_parser.add_argument("--quits", type=int, default=3)
+    roster_parser.set_defaults(func=roster_benchmark)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,129 @@
+import sys
+from array import array
+
+# Lobby event types that change who is in a lobby, interned as their index
+EVENT_TYPES = ("PracticeGameCreatedEvent", "PlayerJoinedGameEvent", "PlayerQuitGameEvent")
+EVENT_CODES = {name: code for code, name in enumerate(EVENT_TYPES)}
+QUIT_CODE = EVENT_CODES["PlayerQuitGameEvent"]
+
+# A custom lobby holds 10 players and 4 spectators, this leaves room for players coming and going
+MAX_TRACKED_SUMMONERS = 32
+
+
+class LobbyRoster:
+    """
+    Compact record of the latest lobby event of each summoner in one lobby, for processes that track hundreds of
+    lobbies at once. Summoner IDs, timestamps and event types are stored in parallel arrays instead of Python objects.
+    Rosters hold at most MAX_TRACKED_SUMMONERS entries, so finding a summoner's slot is a bounded scan of one array.
+    """
+    __slots__ = ('gameinstance_id', 'tournament_code', 'summoner_ids', 'timestamps', 'event_codes', 'snapshot')
+
+    def __init__(self, gameinstance_id=None, tournament_code=None):
+        self.gameinstance_id = gameinstance_id
+        self.tournament_code = tournament_code
+        self.summoner_ids = array('q')
+        self.timestamps = array('q')
+        self.event_codes = array('b')
+        # Players present at the last call to diff()
+        self.snapshot = array('q')
+
+    def _find(self, summoner_id):
+        try:
+            return self.summoner_ids.index(summoner_id)
+        except ValueError:
+            return None
+
+    def _allocate(self, summoner_id):
+        """
+        Find a slot for a new summoner, reusing the slot of the summoner who quit longest ago once the roster is full
+        :return: int index, or None if the roster is full of present players
+        """
+        if len(self.summoner_ids) < MAX_TRACKED_SUMMONERS:
+            self.summoner_ids.append(summoner_id)
+            self.timestamps.append(0)
+            self.event_codes.append(QUIT_CODE)
+            index = len(self.summoner_ids) - 1
+        else:
+            quit_slots = [x for x in range(len(self.event_codes)) if self.event_codes[x] == QUIT_CODE]
+
+            if not quit_slots:
+                return None
+
+            index = min(quit_slots, key=lambda x: self.timestamps[x])
+            self.summoner_ids[index] = summoner_id
+            self.timestamps[index] = 0
+
+        return index
+
+    def apply_event(self, summoner_id, timestamp, event_type):
+        """
+        Record a lobby event, if it is newer than the last one seen for the summoner
+        :param summoner_id: int or numeric str
+        :param timestamp: event time in milliseconds, int or numeric str
+        :param event_type: the eventType of the lobby event
+        :return: boolean - did the event change the roster
+        """
+        code = EVENT_CODES.get(event_type)
+
+        if code is None:
+            return False
+
+        summoner_id = int(summoner_id)
+        timestamp = int(timestamp)
+        index = self._find(summoner_id)
+
+        if index is None:
+            index = self._allocate(summoner_id)
+
+            if index is None:
+                return False
+        elif self.timestamps[index] >= timestamp:
+            return False
+
+        self.timestamps[index] = timestamp
+        self.event_codes[index] = code
+        return True
+
+    def apply_events(self, event_list):
+        """
+        Record every event of a lobby-events response
+        :param event_list: the eventList of a lobby-events response
+        :return: boolean - did any event change the roster
+        """
+        changed = False
+
+        for event in event_list:
+            if event['eventType'] in EVENT_CODES:
+                changed = self.apply_event(event['summonerId'], event['timestamp'], event['eventType']) or changed
+
+        return changed
+
+    def players(self):
+        """
+        Summoners currently in the lobby
+        :return: tuple of int summoner IDs
+        """
+        return tuple(self.summoner_ids[x] for x in range(len(self.summoner_ids)) if self.event_codes[x] != QUIT_CODE)
+
+    def diff(self):
+        """
+        Find who joined and who left since the last call, and take a new snapshot
+        :return: tuple of (list of joined summoner IDs, list of left summoner IDs)
+        """
+        current = array('q', self.players())
+        joined = [x for x in current if x not in self.snapshot]
+        left = [x for x in self.snapshot if x not in current]
+        self.snapshot = current
+        return joined, left
+
+    def size_bytes(self):
+        """
+        Memory used by this roster and its arrays, not counting the tournament code string shared with the game
+        :return: int bytes
+        """
+        return sys.getsizeof(self) + sys.getsizeof(self.summoner_ids) + sys.getsizeof(self.timestamps) + \
+            sys.getsizeof(self.event_codes) + sys.getsizeof(self.snapshot)
+
+    def __repr__(self):
+        return "<LobbyRoster(gameinstance_id={}, tournament_code={}, players={})>"\
+            .format(self.gameinstance_id, self.tournament_code, self.players())
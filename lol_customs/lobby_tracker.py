@@ -0,0 +1,147 @@
+import traceback
+from array import array
+from lol_customs import riot_tournament_api
+from lol_customs.lobby_roster import LobbyRoster
+from lol_customs.tournament_libs import Participant, link_members, session
+
+# Upper bound on lobbies tracked by one process, see LobbyTracker.size_bytes for the memory each one uses
+MAX_TRACKED_LOBBIES = 1000
+
+
+class LobbyTracker:
+    """
+    Keeps a LobbyRoster per open game for a long running tracker process, instead of the game's ORM objects.
+    Participant rows are only written when a poll finds that players joined or left.
+    """
+    def __init__(self, max_lobbies=MAX_TRACKED_LOBBIES):
+        self.max_lobbies = max_lobbies
+        # tournament_code -> LobbyRoster
+        self.rosters = {}
+
+    def track(self, game):
+        """
+        Start tracking the lobby of a game
+        :param game: GameInstance
+        :return: boolean - False if the tracker is full
+        """
+        if game.tournament_code in self.rosters:
+            return True
+        elif len(self.rosters) >= self.max_lobbies:
+            return False
+
+        roster = LobbyRoster(game.id, game.tournament_code)
+
+        # Start from the players already saved, by an earlier run or another tracker, so they aren't added again
+        saved = session.query(Participant.summoner_id).filter(Participant.gameinstance_id==game.id)
+        roster.snapshot = array('q', sorted(int(x.summoner_id) for x in saved if x.summoner_id.isdigit()))
+        session.commit()
+
+        self.rosters[game.tournament_code] = roster
+        return True
+
+    def untrack(self, tournament_code):
+        self.rosters.pop(tournament_code, None)
+
+    def lookup_players(self, summoner_ids):
+        """
+        Find the summoner name and member of each player who joined, like start_game does for the whole lobby
+        :param summoner_ids: list of summoner IDs
+        :return: list of (summoner_id, summoner_name, discord_id) tuples, names and Discord IDs may be None
+        """
+        players = []
+
+        for summoner_id in summoner_ids:
+            summoner_name = riot_tournament_api.get_summoner_name(summoner_id)
+            if summoner_name == 'NAME_LOOKUP_FAILED':
+                summoner_name = None
+            players.append((str(summoner_id), summoner_name))
+
+        try:
+            return link_members(players)
+        except:
+            # Save the players without their members, start_game fills them in when the game starts
+            print(traceback.format_exc())
+            return [(summoner_id, summoner_name, None) for summoner_id, summoner_name in players]
+
+    def save_changes(self, roster, joined, left):
+        """
+        Add Participant rows for the players who joined a lobby and remove the rows of those who left
+        :param roster: LobbyRoster
+        :param joined: list of summoner IDs
+        :param left: list of summoner IDs
+        :return:
+        """
+        # Look the players up before writing, to not hold the database lock during API calls
+        players = self.lookup_players(joined)
+
+        if players:
+            saved = set(x.summoner_id for x in session.query(Participant.summoner_id).filter(
+                Participant.gameinstance_id==roster.gameinstance_id,
+                Participant.summoner_id.in_([x[0] for x in players])))
+
+            for summoner_id, summoner_name, discord_id in players:
+                if summoner_id not in saved:
+                    session.add(Participant(gameinstance_id=roster.gameinstance_id, summoner_id=summoner_id,
+                                            summoner_name=summoner_name, discord_id=discord_id))
+
+        if left:
+            session.query(Participant).filter(Participant.gameinstance_id==roster.gameinstance_id,
+                                              Participant.summoner_id.in_([str(x) for x in left]))\
+                .delete(synchronize_session=False)
+
+        session.commit()
+
+    def poll(self, tournament_code):
+        """
+        Fetch the lobby events of a tracked lobby and save who joined or left since the last poll
+        :param tournament_code:
+        :return: tuple of (list of joined summoner IDs, list of left summoner IDs)
+        """
+        roster = self.rosters[tournament_code]
+        lobby_events = riot_tournament_api.get_lobby_events(tournament_code)
+
+        # Diff even when no new events arrived, so changes whose save failed last poll are saved again
+        if lobby_events and 'eventList' in lobby_events:
+            roster.apply_events(lobby_events['eventList'])
+        elif not roster.summoner_ids:
+            # No events seen yet, diffing would report every saved player as having left
+            return [], []
+
+        previous_snapshot = roster.snapshot
+        joined, left = roster.diff()
+
+        if joined or left:
+            try:
+                self.save_changes(roster, joined, left)
+            except:
+                # Report the same changes again on the next poll
+                roster.snapshot = previous_snapshot
+                raise
+
+        return joined, left
+
+    def poll_all(self):
+        """
+        Poll every tracked lobby
+        :return: dict of tournament_code -> (joined, left) for the lobbies that changed
+        """
+        changes = {}
+
+        for tournament_code in list(self.rosters):
+            try:
+                joined, left = self.poll(tournament_code)
+
+                if joined or left:
+                    changes[tournament_code] = (joined, left)
+            except:
+                session.rollback()
+                print(traceback.format_exc())
+
+        return changes
+
+    def size_bytes(self):
+        """
+        Memory used by the tracked rosters
+        :return: int bytes
+        """
+        return sum(x.size_bytes() for x in self.rosters.values())
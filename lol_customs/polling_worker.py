@@ -0,0 +1,178 @@
+import os
+import socket
+import time
+import traceback
+import zlib
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from lol_customs.tournament_libs import GameInstance, WorkLease, session
+
+LOBBY_TASK = "lobby"
+MATCH_TASK = "match"
+
+
+class PollingWorker:
+    """
+    Polls lobbies and matches for the games this worker holds a lease on. Any number of workers, in separate processes
+    or on separate nodes sharing the tournament database, can run at once: each claims up to batch_size games per task,
+    renews its leases every poll and takes over games whose lease expired because their worker died.
+
+    Lease expiry uses each worker's local clock, so nodes need reasonably synchronized clocks. start_game and
+    finish_game only succeed once per game, which keeps results exactly-once even if a lease is stolen from a worker
+    that was merely slow.
+
+    A bot process using query_service sees the games a worker started or finished once its cached game lists expire,
+    after query_service.GAME_LIST_TTL seconds.
+    """
+    def __init__(self, worker_id=None, lease_seconds=60, batch_size=10):
+        self.worker_id = worker_id or "{}:{}".format(socket.gethostname(), os.getpid())
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.last_heartbeat = None
+
+    def heartbeat(self):
+        """
+        Extend every lease held by this worker
+        :return: int number of leases renewed
+        """
+        now = datetime.now()
+        renewed = session.query(WorkLease).filter(WorkLease.worker_id==self.worker_id)\
+            .update({WorkLease.expire_date: now + timedelta(seconds=self.lease_seconds)}, synchronize_session=False)
+        session.commit()
+        self.last_heartbeat = now
+        return renewed
+
+    def claim(self, task):
+        """
+        Claim games for a task until this worker holds batch_size of them, taking unclaimed games first and then
+        games whose lease expired. Each worker scans the candidates from its own starting point, so concurrent
+        workers mostly go after different games.
+        :param task: LOBBY_TASK or MATCH_TASK
+        :return: list of GameInstance this worker holds the lease of for the task
+        """
+        self.heartbeat()
+
+        if task == LOBBY_TASK:
+            candidates = session.query(GameInstance.id).filter(GameInstance.start_date==None)
+        else:
+            candidates = session.query(GameInstance.id).filter(GameInstance.finish_date==None,
+                                                               GameInstance.start_date!=None)
+        candidate_ids = sorted(x.id for x in candidates)
+        leases = {}
+
+        if candidate_ids:
+            # Plain rows rather than WorkLease objects, which the commits below would expire and reload
+            query = session.query(WorkLease.id, WorkLease.gameinstance_id, WorkLease.worker_id, WorkLease.expire_date)\
+                .filter(WorkLease.task==task, WorkLease.gameinstance_id.in_(candidate_ids))
+            leases = {x.gameinstance_id: x for x in query}
+
+            start = zlib.crc32(self.worker_id.encode()) % len(candidate_ids)
+            candidate_ids = candidate_ids[start:] + candidate_ids[:start]
+
+        owned = len([x for x in leases.values() if x.worker_id == self.worker_id])
+        now = datetime.now()
+        expire_date = now + timedelta(seconds=self.lease_seconds)
+        unclaimed = [x for x in candidate_ids if x not in leases]
+        expired = [leases[x].id for x in candidate_ids
+                   if x in leases and leases[x].worker_id != self.worker_id and leases[x].expire_date < now]
+
+        if owned < self.batch_size and unclaimed:
+            new_leases = [{'gameinstance_id': x, 'task': task, 'worker_id': self.worker_id,
+                           'expire_date': expire_date} for x in unclaimed[:self.batch_size - owned]]
+            try:
+                session.bulk_insert_mappings(WorkLease, new_leases)
+                session.commit()
+                owned += len(new_leases)
+            except IntegrityError:
+                # Another worker claimed one of them first, claim the rest one at a time
+                session.rollback()
+
+                for new_lease in new_leases:
+                    try:
+                        session.bulk_insert_mappings(WorkLease, [new_lease])
+                        session.commit()
+                        owned += 1
+                    except IntegrityError:
+                        session.rollback()
+
+        if owned < self.batch_size and expired:
+            # Steal expired leases, skipping any that another worker got to first
+            stolen = session.query(WorkLease)\
+                .filter(WorkLease.id.in_(expired[:self.batch_size - owned]), WorkLease.expire_date < now)\
+                .update({WorkLease.worker_id: self.worker_id, WorkLease.expire_date: expire_date},
+                        synchronize_session=False)
+            session.commit()
+            owned += stolen
+
+        return session.query(GameInstance).join(WorkLease, WorkLease.gameinstance_id==GameInstance.id)\
+            .filter(WorkLease.task==task, WorkLease.worker_id==self.worker_id).all()
+
+    def release(self, game, task):
+        """
+        Give up the lease on a game, once its task is done
+        :param game: GameInstance
+        :param task: LOBBY_TASK or MATCH_TASK
+        :return:
+        """
+        session.query(WorkLease).filter(WorkLease.gameinstance_id==game.id, WorkLease.task==task,
+                                        WorkLease.worker_id==self.worker_id).delete(synchronize_session=False)
+        session.commit()
+
+    def _heartbeat_if_due(self):
+        if (datetime.now() - self.last_heartbeat).total_seconds() > self.lease_seconds / 3:
+            self.heartbeat()
+
+    def _safe_claim(self, task):
+        try:
+            return self.claim(task)
+        except:
+            # Try again next poll, the leases already held stay valid until they expire
+            session.rollback()
+            print(traceback.format_exc())
+            return []
+
+    def poll_once(self):
+        """
+        Claim games and poll each of them once. Games that started move from the lobby task to the match task.
+        :return: tuple of (list of started GameInstance, list of finished GameInstance) handled by this worker
+        """
+        started_games = []
+        finished_games = []
+
+        for game in self._safe_claim(LOBBY_TASK):
+            try:
+                self._heartbeat_if_due()
+
+                if game.is_game_started():
+                    started_games.append(game)
+
+                if game.start_date is not None:
+                    self.release(game, LOBBY_TASK)
+            except:
+                session.rollback()
+                print(traceback.format_exc())
+
+        for game in self._safe_claim(MATCH_TASK):
+            try:
+                self._heartbeat_if_due()
+
+                if game.is_game_finished():
+                    finished_games.append(game)
+
+                if game.finish_date is not None:
+                    self.release(game, MATCH_TASK)
+            except:
+                session.rollback()
+                print(traceback.format_exc())
+
+        return started_games, finished_games
+
+    def run(self, poll_interval=15):
+        """
+        Poll forever
+        :param poll_interval: seconds to wait between polls
+        :return:
+        """
+        while True:
+            self.poll_once()
+            time.sleep(poll_interval)
@@ -0,0 +1,193 @@
+import time
+import traceback
+from collections import namedtuple
+from itertools import chain
+from sqlalchemy import event, inspect
+from lol_customs import members, tournament_libs
+from lol_customs.members import GdMember
+from lol_customs.tournament_libs import GameInstance
+
+# Snapshots of database rows handed to the bot. Unlike ORM objects, reading them never touches the database.
+MemberProfile = namedtuple('MemberProfile', ['discord_id', 'discord_name', 'summoner_name', 'realm',
+                                             'validation_string', 'validated'])
+GameSummary = namedtuple('GameSummary', ['id', 'tournament_id', 'tournament_code', 'map_name', 'creator_discord_id',
+                                         'create_date', 'start_date', 'finish_date'])
+
+# discord_id -> MemberProfile, or None for Discord IDs without a member
+member_profiles = {}
+# "open" / "active" -> (time loaded, list of GameSummary)
+game_lists = {}
+# Games are also started and finished by PollingWorker processes, whose commits this process never sees, so the game
+# lists are reloaded after this many seconds even without a local write
+GAME_LIST_TTL = 5
+
+
+def _member_profile(member):
+    return MemberProfile(member.discord_id, member.discord_name, member.summoner_name, member.realm,
+                         member.validation_string, member.validated)
+
+
+def _game_summary(game):
+    return GameSummary(game.id, game.tournament_id, game.tournament_code, game.map_name, game.creator_discord_id,
+                       game.create_date, game.start_date, game.finish_date)
+
+
+def get_member_profile(discord_id):
+    """
+    Returns the cached profile of the member tied to a Discord ID, loading it on first use
+    :param discord_id:
+    :return: MemberProfile or None if the Discord ID has no member
+    """
+    if discord_id not in member_profiles:
+        member = members.session.query(GdMember).filter(GdMember.discord_id==discord_id).first()
+
+        if member is not None:
+            member_profiles[discord_id] = _member_profile(member)
+        else:
+            member_profiles[discord_id] = None
+
+    return member_profiles[discord_id]
+
+
+def generate_discord_nickname(discord_id):
+    """
+    Cached version of members.generate_discord_nickname
+    :param discord_id:
+    :return: String or None if the member doesn't exist or isn't validated yet
+    """
+    profile = get_member_profile(discord_id)
+
+    if profile is not None and profile.summoner_name is not None and profile.realm is not None:
+        return profile.summoner_name + " (" + profile.realm + ")"
+    else:
+        return None
+
+
+def is_user_validated(discord_id):
+    """
+    Cached version of members.is_user_validated
+    :param discord_id:
+    :return: boolean
+    """
+    profile = get_member_profile(discord_id)
+
+    if profile is not None:
+        return bool(profile.validated)
+    else:
+        return False
+
+
+def start_validation(discord_id, discord_name):
+    """
+    Cached version of members.start_validation. Only creating a new member reaches the database.
+    :param discord_id:
+    :param discord_name:
+    :return: return validation tuple, first is a boolean indicating if validation was started, second is validation string
+    """
+    profile = get_member_profile(discord_id)
+
+    if profile is not None:
+        return False, profile.validation_string
+    else:
+        return members.start_validation(discord_id, discord_name)
+
+
+def _cached_game_list(name, query):
+    if name not in game_lists or time.monotonic() - game_lists[name][0] >= GAME_LIST_TTL:
+        game_lists[name] = (time.monotonic(), [_game_summary(x) for x in query])
+
+    return game_lists[name][1]
+
+
+def get_open_games():
+    """
+    Cached version of Tournament.get_open_games, at most GAME_LIST_TTL seconds old
+    :return: list of GameSummary
+    """
+    query = tournament_libs.session.query(GameInstance).filter(GameInstance.start_date==None)
+    return _cached_game_list("open", query)
+
+
+def get_active_games():
+    """
+    Cached version of Tournament.get_active_games, at most GAME_LIST_TTL seconds old
+    :return: list of GameSummary
+    """
+    query = tournament_libs.session.query(GameInstance).filter(GameInstance.finish_date==None,
+                                                               GameInstance.start_date!=None)
+    return _cached_game_list("active", query)
+
+
+def clear_cache():
+    """
+    Drop everything cached, eg: after another process wrote members to the database. Game lists expire by
+    themselves after GAME_LIST_TTL.
+    :return:
+    """
+    member_profiles.clear()
+    game_lists.clear()
+
+
+def _pending_changes(session):
+    return session.info.setdefault("query_service_changes", {"members": {}, "games": False, "all_members": False})
+
+
+def _collect_flushed_changes(session, flush_context):
+    """
+    Remember what a flush wrote so the cache can be updated once the transaction commits. Member profiles are
+    captured here because their attributes are expired after the commit.
+    """
+    changes = _pending_changes(session)
+
+    try:
+        for obj in chain(session.new, session.dirty):
+            if isinstance(obj, GdMember):
+                for old_discord_id in inspect(obj).attrs.discord_id.history.deleted:
+                    changes["members"][old_discord_id] = None
+                changes["members"][obj.discord_id] = _member_profile(obj)
+            elif isinstance(obj, GameInstance):
+                changes["games"] = True
+
+        for obj in session.deleted:
+            if isinstance(obj, GdMember):
+                changes["members"][obj.discord_id] = None
+            elif isinstance(obj, GameInstance):
+                changes["games"] = True
+    except:
+        print(traceback.format_exc())
+        changes["all_members"] = True
+        changes["games"] = True
+
+
+def _collect_bulk_changes(update_context):
+    changes = _pending_changes(update_context.session)
+
+    if update_context.mapper.class_ is GdMember:
+        changes["all_members"] = True
+    elif update_context.mapper.class_ is GameInstance:
+        changes["games"] = True
+
+
+def _apply_changes(session):
+    changes = session.info.pop("query_service_changes", None)
+
+    if changes is not None:
+        if changes["all_members"]:
+            member_profiles.clear()
+        else:
+            member_profiles.update(changes["members"])
+
+        if changes["games"]:
+            game_lists.clear()
+
+
+def _discard_changes(session):
+    session.info.pop("query_service_changes", None)
+
+
+for _session_class in (members.DBSession, tournament_libs.session_factory):
+    event.listen(_session_class, "after_flush", _collect_flushed_changes)
+    event.listen(_session_class, "after_bulk_update", _collect_bulk_changes)
+    event.listen(_session_class, "after_bulk_delete", _collect_bulk_changes)
+    event.listen(_session_class, "after_commit", _apply_changes)
+    event.listen(_session_class, "after_rollback", _discard_changes)
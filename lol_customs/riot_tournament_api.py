@@ -1,5 +1,11 @@
 import requests
 import configparser
+import json
+import re
+import time
+from bisect import bisect_right
+from collections import Counter, deque
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
 
 # Configure the Library
@@ -11,6 +17,229 @@ api_key = config.get("RiotAPI", "api_key")
 api_root = "https://americas.api.riotgames.com{}?api_key=" + api_key
 match_api_root = "https://na1.api.riotgames.com{}?api_key=" + api_key
 
+# Request accounting, response caching and record/replay state
+call_counts = Counter()
+cache_ttl = 0
+_response_cache = {}
+_recording = None
+_record_start = None
+_replay = None
+
+
+class RecordedResponse:
+    """
+    Minimal stand-in for a requests Response, used for cached and replayed responses
+    """
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class ReplaySession:
+    """
+    Serves responses from a recording log instead of calling the Riot API.
+
+    GET requests return the most recent response recorded at or before the current replay time, so a poller
+    sees the lobby/match state as it was at that point of the recorded night. Before a URL's first recorded GET
+    nothing is known about it yet, so those requests get a 404 response. POST requests are served in the
+    order they were recorded.
+    """
+    def __init__(self, path, speed=1.0, clock=time.monotonic, latency=0):
+        self.speed = speed
+        self.clock = clock
+        self.latency = latency
+        self.started = clock()
+        self.misses = 0
+        # Requests made before the URL's first recorded response, eg: when polling more often than the recorded bot
+        self.early_requests = 0
+        self.get_times = {}
+        self.get_responses = {}
+        self.post_responses = {}
+
+        for offset, method, url, body, status_code, response in load_recording(path):
+            if method == "GET":
+                self.get_times.setdefault(url, []).append(offset)
+                self.get_responses.setdefault(url, []).append(RecordedResponse(status_code, response))
+            else:
+                self.post_responses.setdefault(url, deque()).append(RecordedResponse(status_code, response))
+
+    def now(self):
+        """
+        Seconds into the recorded session, scaled by the replay speed
+        :return: float
+        """
+        return (self.clock() - self.started) * self.speed
+
+    def serve(self, method, url):
+        """
+        Find the recorded response for a request
+        :param method: GET or POST
+        :param url: the request URL with the api_key removed
+        :return: RecordedResponse, with a 404 status if nothing was recorded for the request
+        """
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == "GET" and url in self.get_times:
+            index = bisect_right(self.get_times[url], self.now()) - 1
+
+            if index >= 0:
+                return self.get_responses[url][index]
+            else:
+                # Serving the first recording here would leak state from the future
+                self.early_requests += 1
+                return RecordedResponse(404, None)
+        elif method == "POST" and self.post_responses.get(url):
+            return self.post_responses[url].popleft()
+        else:
+            self.misses += 1
+            return RecordedResponse(404, None)
+
+
+def _strip_api_key(url):
+    """
+    Remove the api_key from a request URL so it can be logged and matched during replay
+    :param url:
+    :return: str
+    """
+    parts = urlsplit(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query) if key != "api_key"]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), parts.fragment))
+
+
+def _endpoint_name(method, url):
+    """
+    Collapse the IDs and codes in a request URL to get a name to count calls by
+    :param method:
+    :param url:
+    :return: str, eg: GET /lol/tournament/v3/lobby-events/by-code/{}
+    """
+    segments = urlsplit(url).path.split("/")
+    segments = segments[:4] + [x if re.fullmatch("[a-z-]+", x) else "{}" for x in segments[4:]]
+    return method + " " + "/".join(segments)
+
+
+def _now():
+    if _replay is not None:
+        return _replay.now()
+    else:
+        return time.monotonic()
+
+
+def _request(method, full_url, request_body=None):
+    """
+    Send a request to the Riot API, or serve it from the response cache or replay log, recording it if enabled
+    :param method: GET or POST
+    :param full_url: the request URL, including the api_key
+    :param request_body: the JSON body of a POST request
+    :return: requests Response or RecordedResponse
+    """
+    url = _strip_api_key(full_url)
+
+    if method == "GET" and cache_ttl > 0 and url in _response_cache:
+        cached_at, cached_response = _response_cache[url]
+
+        if _now() - cached_at < cache_ttl:
+            return cached_response
+
+    call_counts[_endpoint_name(method, url)] += 1
+
+    if _replay is not None:
+        result = _replay.serve(method, url)
+    elif method == "GET":
+        result = requests.get(full_url)
+    else:
+        result = requests.post(full_url, json=request_body)
+
+    if _recording is not None:
+        try:
+            response = result.json()
+        except ValueError:
+            response = None
+
+        entry = [round(time.monotonic() - _record_start, 3), method, url, request_body, result.status_code, response]
+        _recording.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    if method == "GET" and cache_ttl > 0:
+        _response_cache[url] = (_now(), result)
+
+    return result
+
+
+def _get(full_url):
+    return _request("GET", full_url)
+
+
+def _post(full_url, request_body):
+    return _request("POST", full_url, request_body)
+
+
+def start_recording(path):
+    """
+    Log every request made through this module, and its response, to a file
+    :param path: the file to append the log to, one JSON list per line:
+    [seconds since recording started, method, url, request body, status code, response body]
+    :return:
+    """
+    global _recording, _record_start
+    stop_recording()
+    _recording = open(path, "a", buffering=1)
+    _record_start = time.monotonic()
+
+
+def stop_recording():
+    global _recording
+    if _recording is not None:
+        _recording.close()
+        _recording = None
+
+
+def load_recording(path):
+    """
+    Read a recording log written by start_recording
+    :param path:
+    :return: list of [offset, method, url, request body, status code, response body], ordered by offset
+    """
+    with open(path) as log_file:
+        entries = [json.loads(line) for line in log_file if line.strip()]
+
+    return sorted(entries, key=lambda x: x[0])
+
+
+def start_replay(path, speed=1.0, clock=time.monotonic, latency=0):
+    """
+    Serve all requests from a recording log instead of the Riot API
+    :param path: a log written by start_recording
+    :param speed: how many recorded seconds pass per second of the clock. 1.0 replays with the original timing.
+    :param clock: function returning the current time in seconds. Benchmarks can pass a simulated clock.
+    :param latency: seconds each replayed request waits, to simulate the network round trip
+    :return: ReplaySession
+    """
+    global _replay
+    _replay = ReplaySession(path, speed=speed, clock=clock, latency=latency)
+    _response_cache.clear()
+    return _replay
+
+
+def stop_replay():
+    global _replay
+    _replay = None
+    _response_cache.clear()
+
+
+def set_cache_ttl(seconds):
+    """
+    Reuse GET responses for the given amount of seconds. 0 disables the cache.
+    :param seconds:
+    :return:
+    """
+    global cache_ttl
+    cache_ttl = seconds
+    _response_cache.clear()
+
 
 def create_provider(callback_url, region="NA"):
     """
@@ -26,7 +255,7 @@ def create_provider(callback_url, region="NA"):
 
     request_url = "/lol/tournament/v3/providers"
     full_url = api_root.format(request_url)
-    result = requests.post(full_url, json=request_body)
+    result = _post(full_url, request_body)
     return result.json()
 
 
@@ -44,7 +273,7 @@ def create_tournament(name, provider_id):
 
     request_url = "/lol/tournament/v3/tournaments"
     full_url = api_root.format(request_url)
-    result = requests.post(full_url, json=request_body)
+    result = _post(full_url, request_body)
     return result.json()
 
 
@@ -69,7 +298,7 @@ def create_tournament_code(tournament_id, map_type="SUMMONERS_RIFT", metadata=""
 
     request_url = "/lol/tournament/v3/codes"
     full_url = api_root.format(request_url) + "&tournamentId={}".format(tournament_id)
-    result = requests.post(full_url, json=request_body)
+    result = _post(full_url, request_body)
     return result
 
 
@@ -81,7 +310,7 @@ def get_lobby_events(tournament_code):
     """
     request_url = "/lol/tournament/v3/lobby-events/by-code/{}".format(tournament_code)
     full_url = api_root.format(request_url)
-    result = requests.get(full_url)
+    result = _get(full_url)
     return result.json()
 
 
@@ -94,7 +323,7 @@ def get_match(match_id, tournament_code):
     """
     request_url = '/lol/match/v3/matches/{}/by-tournament-code/{}'.format(match_id, tournament_code)
     full_url = match_api_root.format(request_url)
-    result = requests.get(full_url)
+    result = _get(full_url)
 
     if result.status_code != 200:
         return None
@@ -110,7 +339,7 @@ def get_match_id_list(tournament_code):
     """
     request_url = '/lol/match/v3/matches/by-tournament-code/{}/ids'.format(tournament_code)
     full_url = match_api_root.format(request_url)
-    result = requests.get(full_url)
+    result = _get(full_url)
 
     if result.status_code != 200:
         return []
@@ -126,7 +355,7 @@ def get_summoner_name(summoner_id):
     """
     request_url = '/lol/summoner/v3/summoners/{}'.format(summoner_id)
     full_url = match_api_root.format(request_url)
-    result = requests.get(full_url)
+    result = _get(full_url)
 
     if result.status_code != 200:
         return 'NAME_LOOKUP_FAILED'
@@ -156,7 +385,7 @@ def stub_create_provider(callback_url, region="NA"):
 
     request_url = "/lol/tournament-stub/v3/providers"
     full_url = api_root.format(request_url)
-    result = requests.post(full_url, json=request_body)
+    result = _post(full_url, request_body)
     return result.json()
 
 
@@ -174,7 +403,7 @@ def stub_create_tournament(name, provider_id):
 
     request_url = "/lol/tournament-stub/v3/tournaments"
     full_url = api_root.format(request_url)
-    result = requests.post(full_url, json=request_body)
+    result = _post(full_url, request_body)
     return result.json()
 
 
@@ -199,7 +428,7 @@ def stub_create_tournament_code(tournament_id, map_type="SUMMONERS_RIFT", metada
 
     request_url = "/lol/tournament-stub/v3/codes"
     full_url = api_root.format(request_url) + "&tournamentId={}".format(tournament_id)
-    result = requests.post(full_url, json=request_body)
+    result = _post(full_url, request_body)
     return result
 
 
@@ -211,6 +440,6 @@ def stub_get_lobby_events(tournament_code):
     """
     request_url = "/lol/tournament-stub/v3/lobby-events/by-code/{}".format(tournament_code)
     full_url = api_root.format(request_url)
-    result = requests.get(full_url)
+    result = _get(full_url)
     return result.json()
 
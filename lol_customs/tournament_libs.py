@@ -1,8 +1,9 @@
 import configparser
 import traceback
 import json
-from lol_customs import riot_tournament_api
-from sqlalchemy import Column, Boolean, Integer, String, ForeignKey, create_engine, DateTime
+from lol_customs import members, riot_tournament_api
+from lol_customs.lobby_roster import LobbyRoster
+from sqlalchemy import Column, Boolean, Integer, String, ForeignKey, create_engine, DateTime, UniqueConstraint, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker, scoped_session
 from datetime import datetime
@@ -63,6 +64,26 @@ class TournamentManager:
             print("There is already an active tournament.")
             return False
 
+    def get_member_games(self, discord_id):
+        """
+        Return the games a member played in, oldest first
+        :param discord_id: the member's Discord ID
+        :return: list of GameInstance
+        """
+        query = session.query(GameInstance).join(Participant, Participant.gameinstance_id==GameInstance.id)\
+            .filter(Participant.discord_id==discord_id).order_by(GameInstance.create_date)
+
+        return query.all()
+
+    def count_member_games(self, discord_id):
+        """
+        Return how many finished games a member played in
+        :param discord_id: the member's Discord ID
+        :return: int
+        """
+        return session.query(Participant).join(GameInstance, Participant.gameinstance_id==GameInstance.id)\
+            .filter(Participant.discord_id==discord_id, GameInstance.finish_date!=None).count()
+
 
 class Tournament(Base):
     __tablename__ = "tournaments"
@@ -202,44 +223,41 @@ class GameInstance(Base):
         :return: boolean - did champ select start
         """
         lobby_events = riot_tournament_api.get_lobby_events(self.tournament_code)
+
+        if not lobby_events or 'eventList' not in lobby_events:
+            # Error responses, eg: a 404 before the lobby exists, have no events
+            return False
+
         for event in lobby_events['eventList']:
             if event['eventType'] == 'ChampSelectStartedEvent':
-                self.start_game()
-                return True
+                return self.start_game(lobby_events)
         return False
 
     def is_game_finished(self):
         """
         Checks to see if a game ID exists for the Tournament Code, if it does, that means the game is finished.
-        :return: boolean
+        :return: boolean - True if the game finished and this call recorded its results
         """
         game_ids = riot_tournament_api.get_match_id_list(self.tournament_code)
 
         if len(game_ids) > 0:
             eog_json = riot_tournament_api.get_match(game_ids[0], self.tournament_code)
-            self.finish_game(eog_json)
-            return True
+            return self.finish_game(eog_json)
         else:
             return False
 
     def get_players_in_lobby(self):
-        player_actions = {}
-        player_list = []
-
+        """
+        Get the summoner names of the players currently in the game lobby
+        :return: list of str
+        """
+        roster = LobbyRoster(self.id, self.tournament_code)
         lobby_events = riot_tournament_api.get_lobby_events(self.tournament_code)
 
-        for event in lobby_events['eventList']:
-            if event['eventType'] == "PracticeGameCreatedEvent" or event['eventType'] == "PlayerJoinedGameEvent" or event['eventType'] == "PlayerQuitGameEvent":
-                if event['summonerId'] not in player_actions.keys():
-                    player_actions[event['summonerId']] = [event['timestamp'], event['eventType']]
-                else:
-                    if player_actions[event['summonerId']][0] < event['timestamp']:
-                        player_actions[event['summonerId']] = [event['timestamp'], event['eventType']]
-
-        for key in player_actions.keys():
-            if player_actions[key][1] == "PlayerJoinedGameEvent" or player_actions[key][1] == "PracticeGameCreatedEvent":
-                player_list.append(riot_tournament_api.get_summoner_name(key))
-        return player_list
+        if lobby_events and 'eventList' in lobby_events:
+            roster.apply_events(lobby_events['eventList'])
+
+        return [riot_tournament_api.get_summoner_name(x) for x in roster.players()]
 
     def get_lobby_status(self):
         """
@@ -260,24 +278,120 @@ class GameInstance(Base):
                 if event['eventType'] == 'GameAllocationStartedEvent':
                     self.start_game()
 
-    def finish_game(self, eog_json):
+    def finish_game(self, eog_json=None):
         """
-        Sets a game into finished mode
-        :return:
+        Sets a game into finished mode and reconciles its Participants with the players in the match results.
+        Only the first caller succeeds, so several workers polling the same game can't record its results twice.
+        :param eog_json: the match DTO
+        :return: boolean - False if the game was already finished
         """
-        self.finish_date = datetime.now()
-        self.eog_json = json.dumps(eog_json)
+        players = None
+
+        if eog_json is not None and 'participantIdentities' in eog_json:
+            try:
+                players = link_members([(str(x['player']['summonerId']), x['player']['summonerName'])
+                                        for x in eog_json['participantIdentities']])
+            except:
+                print(traceback.format_exc())
+
+        updated = session.query(GameInstance).filter(GameInstance.id==self.id, GameInstance.finish_date==None)\
+            .update({GameInstance.finish_date: datetime.now(), GameInstance.eog_json: json.dumps(eog_json)},
+                    synchronize_session=False)
         session.commit()
-        return True
 
-    def start_game(self):
+        if updated == 1 and players is not None:
+            self.save_participants(players)
+
+        return updated == 1
+
+    def start_game(self, lobby_events=None):
         """
-        Sets a game into start mode
-        :return:
+        Sets a game into start mode and saves the players in the lobby as its Participants. Only the first caller
+        succeeds.
+        :param lobby_events: the lobby-events response that showed the game started, fetched if not given
+        :return: boolean - False if the game was already started
         """
-        self.start_date = datetime.now()
+        players = None
+
+        if self.start_date is None:
+            try:
+                # Look the players up before updating the game, to not hold the database lock during API calls
+                if lobby_events is None:
+                    lobby_events = riot_tournament_api.get_lobby_events(self.tournament_code)
+
+                roster = LobbyRoster(self.id, self.tournament_code)
+                roster.apply_events(lobby_events['eventList'])
+                players = []
+
+                for summoner_id in roster.players():
+                    summoner_name = riot_tournament_api.get_summoner_name(summoner_id)
+                    if summoner_name == 'NAME_LOOKUP_FAILED':
+                        summoner_name = None
+                    players.append((str(summoner_id), summoner_name))
+
+                players = link_members(players)
+            except:
+                # Participants will be filled in from the match results when the game finishes
+                print(traceback.format_exc())
+                players = None
+
+        updated = session.query(GameInstance).filter(GameInstance.id==self.id, GameInstance.start_date==None)\
+            .update({GameInstance.start_date: datetime.now()}, synchronize_session=False)
         session.commit()
-        return True
+
+        if updated == 1 and players is not None:
+            self.save_participants(players)
+
+        return updated == 1
+
+    def save_participants(self, players):
+        """
+        Reconcile the game's Participants in their own transaction, after the start/finish update was committed, so a
+        failure here can't undo or block that update
+        :param players: list of (summoner_id, summoner_name, discord_id) tuples
+        :return: boolean - were the Participants saved
+        """
+        try:
+            self.reconcile_participants(players)
+            session.commit()
+            return True
+        except:
+            session.rollback()
+            print(traceback.format_exc())
+            return False
+
+    def reconcile_participants(self, players):
+        """
+        Make the game's Participant rows match a list of players. Rows are inserted and updated in batches.
+        Does not commit.
+        :param players: list of (summoner_id, summoner_name, discord_id) tuples, see link_members
+        :return:
+        """
+        existing = {x.summoner_id: x for x in
+                    session.query(Participant).filter(Participant.gameinstance_id==self.id)}
+        new_rows = []
+        updated_rows = []
+
+        for summoner_id, summoner_name, discord_id in players:
+            row = {'gameinstance_id': self.id, 'summoner_id': summoner_id, 'summoner_name': summoner_name,
+                   'discord_id': discord_id}
+
+            if summoner_id not in existing:
+                new_rows.append(row)
+            elif (existing[summoner_id].summoner_name, existing[summoner_id].discord_id) != \
+                    (row['summoner_name'], row['discord_id']):
+                row['id'] = existing[summoner_id].id
+                updated_rows.append(row)
+
+        player_ids = set(x[0] for x in players)
+        left = [x.id for x in existing.values() if x.summoner_id not in player_ids]
+
+        if new_rows:
+            session.bulk_insert_mappings(Participant, new_rows)
+        if updated_rows:
+            session.bulk_update_mappings(Participant, updated_rows)
+        if left:
+            session.query(Participant).filter(Participant.id.in_(left)).delete(synchronize_session=False)
 
     def parse_game_results(self):
         # TODO: complete the parsing and return a results summary dict
@@ -296,12 +410,55 @@ class GameInstance(Base):
                 team_two_players += player_identities[player['participantId']] + "\n"
 
 
+def link_members(players):
+    """
+    Find the Discord ID of each player's member by summoner name, with one query to the members database
+    :param players: list of (summoner_id, summoner_name) tuples, summoner_name may be None
+    :return: list of (summoner_id, summoner_name, discord_id) tuples, discord_id is None for players without a member
+    """
+    summoner_names = [x[1] for x in players if x[1] is not None]
+    discord_ids = {}
+
+    if summoner_names:
+        try:
+            query = members.session.query(members.GdMember.summoner_name, members.GdMember.discord_id)\
+                .filter(members.GdMember.summoner_name.in_(summoner_names))
+            discord_ids = {x.summoner_name: x.discord_id for x in query}
+        except:
+            members.session.rollback()
+            raise
+
+    return [(summoner_id, summoner_name, discord_ids.get(summoner_name)) for summoner_id, summoner_name in players]
+
+
+class WorkLease(Base):
+    """
+    A claim by one polling worker on a GameInstance, so several worker processes can split the polling between them.
+    task is "lobby" for open games polled until they start, or "match" for active games polled until they finish.
+    """
+    __tablename__ = "workleases"
+    __table_args__ = (UniqueConstraint('gameinstance_id', 'task'),)
+    id = Column(Integer, primary_key=True)
+    gameinstance_id = Column(Integer, ForeignKey('gameinstances.id'))
+    task = Column(String)
+    worker_id = Column(String)
+    expire_date = Column(DateTime)
+
+    def __repr__(self):
+        return "<WorkLease(id={}, gameinstance_id={}, task={}, worker_id={}, expire_date={})>"\
+            .format(self.id, self.gameinstance_id, self.task, self.worker_id, self.expire_date)
+
+
 class Participant(Base):
     __tablename__ = "participants"
+    __table_args__ = (Index('ix_participants_discord_id_gameinstance_id', 'discord_id', 'gameinstance_id'),
+                      UniqueConstraint('gameinstance_id', 'summoner_id'))
     id = Column(Integer, primary_key=True)
     discord_id = Column(String)
-    gameinstance_id = Column(Integer, ForeignKey('gameinstances.id'))
+    summoner_id = Column(String)
+    summoner_name = Column(String)
+    gameinstance_id = Column(Integer, ForeignKey('gameinstances.id'), index=True)
 
     def __repr__(self):
-        return "<Participant(id={} discord_id={} tournament_id={})>"\
-            .format(self.id, self.discord_id, self.tournament_id)
+        return "<Participant(id={}, discord_id={}, summoner_id={}, summoner_name={}, gameinstance_id={})>"\
+            .format(self.id, self.discord_id, self.summoner_id, self.summoner_name, self.gameinstance_id)